@@ -25,3 +25,17 @@ CREATE TABLE executions (
     FOREIGN KEY(project_id) REFERENCES projects(ROWID)
     FOREIGN KEY(session_id) REFERENCES sessions(ROWID)
 );
+
+-- History is always read in exec_time order, filtered by session or
+-- project; these let SQLite walk the matching rows in order without a sort.
+CREATE INDEX idx_exec_session_time ON executions(session_id, exec_time);
+CREATE INDEX idx_exec_project_time ON executions(project_id, exec_time);
+
+-- The last execution written to each history file by the write subcommand,
+-- so that "write --append" only has to write the executions after it.
+CREATE TABLE writes (
+    path TEXT PRIMARY KEY,
+    last_exec_id INTEGER
+);
+
+PRAGMA user_version = 2;
@@ -12,21 +12,178 @@ storing the history. History can be customized through a JSON configuration
 file.
 """
 
+import functools
 import os
 import re
 import sys
-from typing import Generator, Iterable, Optional, Tuple, Union
+from typing import Dict, Generator, Iterable, Optional, Tuple, Union
 
 import argparse
-import json
 import sqlite3
 
+# Since we run on every shell prompt, modules which only some subcommands
+# need (json, socket, socketserver) are imported where they're used rather
+# than here, to keep startup of the common save path fast. (re is already
+# loaded by argparse, so it costs us nothing.)
+
 EXEC_TABLE = "executions"
+
+# Version of the schema below, stored in the database's user_version. Bump
+# it whenever SCHEMA_SQL changes so existing databases are migrated.
+SCHEMA_VERSION = 2
+
+# Keep in sync with database.sql.
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS commands (
+    -- rowid
+    value TEXT UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS projects (
+    -- rowid
+    name TEXT UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    -- rowid
+    name TEXT UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS executions (
+    command_id INTEGER,
+    project_id INTEGER,
+    session_id INTEGER,
+
+    pwd TEXT,
+    exec_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+
+    FOREIGN KEY(command_id) REFERENCES commands(ROWID),
+    FOREIGN KEY(project_id) REFERENCES projects(ROWID)
+    FOREIGN KEY(session_id) REFERENCES sessions(ROWID)
+);
+
+-- History is always read in exec_time order, filtered by session or
+-- project; these let SQLite walk the matching rows in order without a sort.
+CREATE INDEX IF NOT EXISTS idx_exec_session_time ON executions(session_id, exec_time);
+CREATE INDEX IF NOT EXISTS idx_exec_project_time ON executions(project_id, exec_time);
+
+-- The last execution written to each history file by the write subcommand,
+-- so that "write --append" only has to write the executions after it.
+CREATE TABLE IF NOT EXISTS writes (
+    path TEXT PRIMARY KEY,
+    last_exec_id INTEGER
+);
+"""
+
 HOME_DIR = os.path.expanduser("~")
 
+# INSERT ... RETURNING was added in SQLite 3.35.0.
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Statements used on the save path. These are defined once so that every
+# call hands the identical SQL text to the connection's statement cache.
+#
+# We deliberately don't use an upsert (ON CONFLICT DO UPDATE ... RETURNING)
+# here: while it returns the ROWID in one statement either way, the no-op
+# update still rewrites the row's page on every repeat command. An ignored
+# insert writes nothing. INSERT OR IGNORE is used rather than ON CONFLICT DO
+# NOTHING as the latter needs SQLite 3.24.
+RETURNING_SQL = " RETURNING ROWID" if HAS_RETURNING else ""
+INSERT_COMMAND_SQL = "INSERT OR IGNORE INTO commands(value) VALUES (?)" + RETURNING_SQL + ";"
+INSERT_PROJECT_SQL = "INSERT OR IGNORE INTO projects(name) VALUES (?)" + RETURNING_SQL + ";"
+INSERT_SESSION_SQL = "INSERT OR IGNORE INTO sessions(name) VALUES (?)" + RETURNING_SQL + ";"
+SELECT_COMMAND_SQL = "SELECT ROWID FROM commands WHERE value=? LIMIT 1;"
+SELECT_PROJECT_SQL = "SELECT ROWID FROM projects WHERE name=? LIMIT 1;"
+SELECT_SESSION_SQL = "SELECT ROWID FROM sessions WHERE name=? LIMIT 1;"
+
+# Conservative bound on the number of ? parameters in one statement; older
+# SQLite builds default SQLITE_MAX_VARIABLE_NUMBER to 999.
+MAX_SQL_VARIABLES = 999
+
+# In-process cache of value -> ROWID for the commands, projects, and
+# sessions tables. These tables are append-only, so an entry never goes stale
+# unless the transaction which inserted it is rolled back; callers must call
+# clear_id_cache() when that happens. A process only ever talks to a single
+# database, so entries aren't keyed by database path.
+ID_CACHE_SIZE = 4096
+ID_CACHE: Dict[str, Dict[str, int]] = {
+    "commands": {},
+    "projects": {},
+    "sessions": {},
+}
+
+# The daemon commits queued saves once this many are waiting, or once the
+# oldest has waited this many seconds.
+DAEMON_BATCH_SIZE = 100
+DAEMON_BATCH_DELAY = 0.05
+
+# How long, in seconds, either end of a daemon connection waits on the other.
+# A shell prompt must never hang on a stuck daemon, so clients give up,
+# saving the command themselves if they couldn't send it; the daemon drops
+# idle clients so they can't block everyone else.
+DAEMON_TIMEOUT = 1.0
+
+# How long, in milliseconds, the daemon waits on another writer's lock before
+# giving up on a commit and retrying it later. The daemon serves clients on
+# the same thread, so this must be well under DAEMON_TIMEOUT.
+DAEMON_BUSY_TIMEOUT = 100
+
+INSERT_EXECUTION_SQL = "INSERT INTO executions (command_id, project_id, " + \
+                       "session_id, pwd) VALUES (?, ?, ?, ?);"
+
+# Statements used to track what the write subcommand last wrote.
+SELECT_LAST_EXEC_SQL = "SELECT max(ROWID) FROM executions;"
+SELECT_WRITE_SQL = "SELECT last_exec_id FROM writes WHERE path=?;"
+# The recorded execution only ever moves forward, so a slower writer can't
+# make the next append repeat history.
+INSERT_WRITE_SQL = "INSERT INTO writes (path, last_exec_id) VALUES (?, ?) " + \
+                   "ON CONFLICT(path) DO UPDATE SET " + \
+                   "last_exec_id=max(last_exec_id, excluded.last_exec_id);"
+
 OInt = Optional[int]
 ColumnsType = Union[str, Tuple[str]]
 
+# Characters with special meaning in a Python regex. Patterns without any
+# of these are plain literals and can be matched with GLOB instead. These
+# include all of GLOB's own special characters (*, ?, and [), so such a
+# literal can go into a GLOB pattern as is.
+REGEX_SPECIAL = frozenset(".^$*+?{}[]\\|()")
+
+# Mapping of descriptive column names to the SELECT expression for that
+# column and, when the value lives in another table, the JOIN clause needed
+# to reach it. "{table}" is replaced by the table being queried.
+COLUMN_MAP = {
+    "command": ("commands.value", "commands ON {table}.command_id=commands.ROWID"),
+    "command_id": ("{table}.command_id", None),
+    "session": ("sessions.name", "sessions ON {table}.session_id=sessions.ROWID"),
+    "session_id": ("{table}.session_id", None),
+    "project": ("projects.name", "projects ON {table}.project_id=projects.ROWID"),
+    "project_id": ("{table}.project_id", None),
+    "pwd": ("{table}.pwd", None),
+    "exec_time": ("{table}.exec_time", None),
+}
+
+# Mapping of list format specifiers (e.g., %c) to history columns.
+# The command number (%i) isn't a column and is handled separately.
+FORMAT_FIELDS = {
+    'c': "command",
+    's': "session",
+    'p': "project",
+    'd': "pwd",
+    't': "exec_time",
+}
+
+# Tokens of the list format mini-language which need translating into a
+# str.format template: a % specifier (possibly cut short by the end of the
+# string) or a literal brace.
+FORMAT_RE = re.compile(r'%(.?)|[{}]', re.DOTALL)
+
+# Required keys of the configuration, with their expected types.
+REQUIRED_CONFIG_KEYS = (
+    ("database", str),
+    ("sessions_dir", str),
+)
+
 def db_conn(config: dict):
     """
     Create a database connection out of the configuration object. If the
@@ -34,109 +191,173 @@ def db_conn(config: dict):
     """
     assert 'database' in config
 
-    # We equate database not existing to database not being initialized.
-    # This isn't technically true as an empty database file could exist and
-    # we wouldn't create the corresponding tables, but it suffices for now.
-    if not os.path.isfile(config['database']):
-        init_db()
+    # We manage transactions explicitly with BEGIN, rather than letting the
+    # sqlite3 module implicitly open one before the first DML statement.
+    conn = sqlite3.connect(config['database'], isolation_level=None)
+
+    # WAL mode persists in the database header, so we only need to switch
+    # the journal mode the first time we open a given database. This lets
+    # readers (list, write) run concurrently with writers (save) from other
+    # shells, and turns each commit into an append to the log.
+    journal_mode = conn.execute("PRAGMA journal_mode;").fetchone()[0]
+    if journal_mode.lower() != "wal":
+        conn.execute("PRAGMA journal_mode=WAL;")
+
+    # The remaining PRAGMAs are per-connection and must be set on every open.
+    # With WAL, synchronous=NORMAL is still safe against corruption; we only
+    # risk losing the last few commands on power loss, which is acceptable
+    # for shell history.
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-20000;")
+    conn.execute("PRAGMA busy_timeout=5000;")
+    conn.execute("PRAGMA mmap_size=134217728;")
+
+    # A new database (or one created by an older version of database.sql)
+    # reports an older schema version; bring it up to date.
+    user_version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    if user_version < SCHEMA_VERSION:
+        init_db(conn)
+
+    return conn
+
+
+def close_conn(conn):
+    """
+    Close a connection created by db_conn(...). Any uncommitted changes are
+    discarded, so callers must commit first.
 
-    return sqlite3.connect(config['database'])
+    SQLite recommends running PRAGMA optimize before closing short-lived
+    connections: it is usually a no-op, but refreshes the query planner's
+    statistics when they've drifted.
+    """
+    conn.execute("PRAGMA optimize;")
+    conn.close()
 
 
-def init_db():
+def init_db(conn):
     """
-    Initialize a database, creating the required tables.
+    Initialize a database, creating the required tables and indexes.
 
-    At the current time we don't support creating anything, however, we should
-    eventually support both creating and migrating an existing database to the
-    latest set of columns.
+    Every statement in SCHEMA_SQL is idempotent, so this both creates a new
+    database and migrates an existing one to the latest schema, after which
+    we record SCHEMA_VERSION so later connections can skip it.
     """
-    raise Exception("Must initialize database prior to using.")
+    conn.executescript("BEGIN;" + SCHEMA_SQL +
+                       "PRAGMA user_version=%d; COMMIT;" % SCHEMA_VERSION)
 
 
-def save_command(conn, command: str) -> int:
+def cache_id(table: str, value: str, row_id: int) -> int:
     """
-    Save a command to the database, returning its ROWID. Since commands must
-    be unique per the database schema, if the command already exists, we
-    query the ROWID from the database.
+    Remember the ROWID of a value in the given table, returning the ROWID.
+    When the cache is full we simply start over; the working set of a shell
+    is small so this rarely happens.
     """
-    cur = conn.cursor()
+    cache = ID_CACHE[table]
+    if len(cache) >= ID_CACHE_SIZE:
+        cache.clear()
+    cache[value] = row_id
+    return row_id
 
-    # Save is a bit of a misnomer: we try inserting the command and return the
-    # ROWID if it succeeds. However,
-    command_id = None
 
-    try:
-        # Try to insert the command into the database.
-        cur.execute("INSERT INTO commands VALUES (?);", [command])
-        command_id = cur.lastrowid
-    except sqlite3.IntegrityError:
-        # We cause an IntegrityError if we insert a command which already
-        # exists in the database. So, select it. All other errors are not
-        # caught.
-        cur.execute("SELECT ROWID FROM commands WHERE value=? LIMIT 1;", [command])
+def clear_id_cache():
+    """
+    Forget all cached ROWIDs. This must be called whenever a transaction
+    which may have inserted into the commands, projects, or sessions tables
+    is rolled back.
+    """
+    for cache in ID_CACHE.values():
+        cache.clear()
+
+
+def insert_or_select(cur, insert_sql: str, select_sql: str, value: str) -> int:
+    """
+    Insert a unique value if it is missing and return its ROWID. A new value
+    costs a single statement; we only need the follow-up SELECT when the
+    value already existed. No IntegrityError is ever raised.
+    """
+    cur.execute(insert_sql, (value,))
+    if HAS_RETURNING:
         row = cur.fetchone()
-        command_id = row[0]
+        if row is not None:
+            return row[0]
+    elif cur.rowcount == 1:
+        return cur.lastrowid
 
-    # Technically we need to only commit if we write to the database, but
-    # we always commit.
-    conn.commit()
-    cur.close()
+    cur.execute(select_sql, (value,))
+    return cur.fetchone()[0]
 
-    return command_id
 
+def save_command(cur, command: str) -> int:
+    """
+    Save a command to the database, returning its ROWID. Since commands must
+    be unique per the database schema, if the command already exists, we
+    query the ROWID from the database.
 
-def save_project(conn, project: str) -> int:
+    The caller owns the transaction: we neither commit nor close the cursor.
+    """
+    # Skip the database entirely if we've seen this command before.
+    command_id = ID_CACHE["commands"].get(command)
+    if command_id is not None:
+        return command_id
+
+    # Save is a bit of a misnomer: we insert the command if it is new and
+    # return its ROWID regardless of whether it already existed.
+    command_id = insert_or_select(cur, INSERT_COMMAND_SQL, SELECT_COMMAND_SQL,
+                                  command)
+
+    return cache_id("commands", command, command_id)
+
+
+def save_project(cur, project: str) -> int:
     """
     Save a project name to the database, returning its ROWID. Since projects
     must be unique per the database schema, if the project already exists, we
     query the ROWID from the database.
     """
-    cur = conn.cursor()
-
     # See comments in save_command(...).
-    project_id = None
-
-    try:
-        cur.execute("INSERT INTO projects VALUES (?);", [project])
-        project_id = cur.lastrowid
-    except sqlite3.IntegrityError:
-        cur.execute("SELECT ROWID FROM projects WHERE name=? LIMIT 1;", [project])
-        row = cur.fetchone()
-        project_id = row[0]
+    project_id = ID_CACHE["projects"].get(project)
+    if project_id is not None:
+        return project_id
 
-    conn.commit()
-    cur.close()
+    project_id = insert_or_select(cur, INSERT_PROJECT_SQL, SELECT_PROJECT_SQL,
+                                  project)
 
-    return project_id
+    return cache_id("projects", project, project_id)
 
 
-def save_session(conn, session):
+def save_session(cur, session):
     """
     Save a session name to the database, returning its ROWID. Since sessions
     must be unique per the database schema, if the project already exists, we
     query the ROWID from the database.
     """
-    cur = conn.cursor()
-
     # See comments in save_command(...).
-    session_id = None
+    session_id = ID_CACHE["sessions"].get(session)
+    if session_id is not None:
+        return session_id
 
-    try:
-        cur.execute("INSERT INTO sessions VALUES (?);", [session])
-        session_id = cur.lastrowid
-    except sqlite3.IntegrityError:
-        cur.execute("SELECT ROWID FROM sessions WHERE name=? LIMIT 1;", [session])
-        row = cur.fetchone()
-        session_id = row[0]
+    session_id = insert_or_select(cur, INSERT_SESSION_SQL, SELECT_SESSION_SQL,
+                                  session)
 
-    conn.commit()
-    cur.close()
+    return cache_id("sessions", session, session_id)
 
-    return session_id
+
+def current_dir() -> str:
+    """
+    Return the current directory. When run from the shell, it exports the
+    directory as PWD, which saves us a getcwd() syscall on every prompt; the
+    shell's value is also the logical path the user sees, before symlinks are
+    resolved.
+    """
+    pwd = os.environ.get('PWD')
+    if pwd and os.path.isabs(pwd):
+        return pwd
+    return os.getcwd()
 
 
-def save_context(conn, command_id: int, project_id: int, session_id: int) -> None:
+def save_context(cur, command_id: int, project_id: int, session_id: int,
+                 pwd: Optional[str] = None) -> None:
     """
     Save the context of a command to the database; we assume that the CWD
     is the same as where the command was executed. This isn't strictly true
@@ -148,30 +369,26 @@ def save_context(conn, command_id: int, project_id: int, session_id: int) -> Non
     This could be fixed by saving the PWD on the session object, using it
     to set the PWD for this command, then updating it on the session object
     again.
-    """
-    cur = conn.cursor()
 
-    # The command's PWD currently isn't yet configurable.
-    pwd = os.getcwd()
-    row = [command_id, project_id, session_id, pwd]
-
-    cur.execute("INSERT INTO executions (command_id, project_id, " +
-                "session_id, pwd) VALUES (?, ?, ?, ?);", row)
+    When saving on behalf of another process (e.g., from the daemon), pwd
+    should be given explicitly as our CWD is meaningless.
+    """
+    if pwd is None:
+        pwd = current_dir()
+    row = (command_id, project_id, session_id, pwd)
 
     # Unlike the other save_{command,session,project} commands, we don't
     # return a ROWID as these are meant to be read as a list and never
     # updated (and likely never cross-referenced).
-    conn.commit()
-    cur.close()
+    cur.execute(INSERT_EXECUTION_SQL, row)
 
 
-def hist_save(config, command: str, project: str, session: str):
+def save_execution(conn, command: str, project: str, session: str,
+                   pwd: Optional[str] = None):
     """
-    Handle the command line subcommand "save": save a given command to the
-    given project and session.
+    Save a single execution of a command to the given project and session,
+    committing it in its own transaction.
     """
-    conn = db_conn(config)
-
     # Find or get the following objects from the database. The goal of this
     # is to separate the actual commands, projects, or session names from
     # the system it is run on: this should allow us to sync across multiple
@@ -181,15 +398,406 @@ def hist_save(config, command: str, project: str, session: str):
     #
     # However, it is dependent on sessions being unique across synced systems,
     # so it is recommended that the hostname be included in the session name.
-    command_id = save_command(conn, command)
-    project_id = save_project(conn, project)
-    session_id = save_session(conn, session)
+    #
+    # All four writes happen inside a single transaction so that saving a
+    # command costs one commit rather than one per table. The connection's
+    # context manager commits on success and rolls back on any exception.
+    #
+    # BEGIN IMMEDIATE takes the write lock up front. A deferred transaction
+    # which reads before writing can fail to upgrade its lock when another
+    # shell commits in between, and busy_timeout doesn't help there.
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            cur = conn.cursor()
+            command_id = save_command(cur, command)
+            project_id = save_project(cur, project)
+            session_id = save_session(cur, session)
+
+            # Save the execution context of the particular command to the
+            # database.
+            save_context(cur, command_id, project_id, session_id, pwd)
+    except BaseException:
+        # The transaction was rolled back; any ROWIDs cached during it may
+        # no longer exist.
+        clear_id_cache()
+        raise
+
+
+def hist_save(config, command: str, project: str, session: str,
+              via_daemon: bool = False):
+    """
+    Handle the command line subcommand "save": save a given command to the
+    given project and session.
 
-    # Save the execution context of the particular command to the database.
-    save_context(conn, command_id, project_id, session_id)
+    With via_daemon, the command is handed to a running "daemon" subcommand
+    instead; if none is listening we fall back to saving it ourselves.
+    """
+    if via_daemon:
+        request = {
+            "cmd": "save",
+            "command": command,
+            "project": project,
+            "session": session,
+            "pwd": current_dir(),
+        }
+        if send_to_daemon(config, request):
+            return
 
-    conn.commit()
-    conn.close()
+    conn = db_conn(config)
+    try:
+        save_execution(conn, command, project, session)
+    finally:
+        close_conn(conn)
+
+
+def save_many(cur, table: str, column: str, values: Iterable[str]) -> dict:
+    """
+    Save many unique values (commands, projects, or sessions) to the given
+    table at once, returning a map from each value to its ROWID.
+
+    Like the other save_* helpers, the caller owns the transaction.
+    """
+    cache = ID_CACHE[table]
+    ids = {}
+    distinct = []
+    for value in set(values):
+        if value in cache:
+            ids[value] = cache[value]
+        else:
+            distinct.append(value)
+
+    # Insert whatever is missing with one prepared statement, then read all
+    # of the ROWIDs back in as few SELECTs as the parameter limit allows.
+    cur.executemany("INSERT OR IGNORE INTO " + table + "(" + column + ") " +
+                    "VALUES (?);",
+                    [(value,) for value in distinct])
+
+    for start in range(0, len(distinct), MAX_SQL_VARIABLES):
+        chunk = distinct[start:start + MAX_SQL_VARIABLES]
+        placeholders = ",".join("?" * len(chunk))
+        cur.execute("SELECT ROWID, " + column + " FROM " + table + " WHERE " +
+                    column + " IN (" + placeholders + ");", chunk)
+        for row_id, value in cur:
+            ids[value] = cache_id(table, value, row_id)
+
+    return ids
+
+
+def parse_batch(batch_fp, project: Optional[str], session: Optional[str]) -> list:
+    """
+    Parse a batch of commands to save, one JSON object per line. Each object
+    must have a "command" key and may override the "project", "session", and
+    "pwd" of the command; these otherwise default to the values given on the
+    command line and the current directory.
+    """
+    import json
+
+    pwd = current_dir()
+    batch = []
+    for l_id, line in enumerate(batch_fp):
+        if not line.strip():
+            continue
+
+        item = json.loads(line)
+        if not isinstance(item, dict) or "command" not in item:
+            raise ValueError("Missing command key on line %d of batch" % (l_id+1))
+
+        execution = (item["command"], item.get("project", project),
+                     item.get("session", session), item.get("pwd", pwd))
+        if not execution[1] or not execution[2]:
+            raise ValueError("Missing project or session on line %d of batch" %
+                             (l_id+1))
+        for key, value in zip(("command", "project", "session", "pwd"),
+                              execution):
+            if not isinstance(value, str):
+                raise ValueError("Key %s not of type str on line %d of batch" %
+                                 (key, l_id+1))
+
+        batch.append(execution)
+
+    return batch
+
+
+def parse_batch_null(batch_fp, project: Optional[str],
+                     session: Optional[str]) -> list:
+    """
+    Parse a batch of commands to save as NUL-terminated fields, three per
+    command: the command, its project, and its session. Empty project and
+    session fields default to the values given on the command line.
+
+    Unlike JSON, this is trivial to produce from a shell (printf '%s\\0')
+    and allows commands to contain newlines.
+    """
+    fields = batch_fp.read().split("\0")
+
+    # The last field is terminated too, leaving an empty string at the end.
+    if fields and not fields[-1]:
+        fields.pop()
+    if len(fields) % 3 != 0:
+        raise ValueError("Expected three NUL-terminated fields per command " +
+                         "in batch, got %d fields" % len(fields))
+
+    pwd = current_dir()
+    batch = []
+    for f_id in range(0, len(fields), 3):
+        command, item_project, item_session = fields[f_id:f_id + 3]
+        item_project = item_project or project
+        item_session = item_session or session
+        if not item_project or not item_session:
+            raise ValueError("Missing project or session for command %d of batch" %
+                             (f_id // 3 + 1))
+
+        batch.append((command, item_project, item_session, pwd))
+
+    return batch
+
+
+def save_executions(conn, batch: list):
+    """
+    Save many executions, each a (command, project, session, pwd) tuple, in a
+    single transaction.
+    """
+    try:
+        with conn:
+            # See comments in save_execution(...).
+            conn.execute("BEGIN IMMEDIATE;")
+            cur = conn.cursor()
+            command_ids = save_many(cur, "commands", "value",
+                                    (item[0] for item in batch))
+            project_ids = save_many(cur, "projects", "name",
+                                    (item[1] for item in batch))
+            session_ids = save_many(cur, "sessions", "name",
+                                    (item[2] for item in batch))
+
+            # executemany(...) consumes the rows as it goes, so there's no
+            # need to build a second copy of the batch.
+            rows = ((command_ids[command], project_ids[item_project],
+                     session_ids[item_session], pwd)
+                    for command, item_project, item_session, pwd in batch)
+            cur.executemany(INSERT_EXECUTION_SQL, rows)
+    except BaseException:
+        # See comments in save_execution(...).
+        clear_id_cache()
+        raise
+
+
+def hist_save_batch(config, batch_fp, project: Optional[str],
+                    session: Optional[str], null: bool = False):
+    """
+    Handle the command line subcommand "save-batch": save many commands read
+    from batch_fp in a single transaction. This amortizes process startup,
+    connection setup, and the commit across the whole batch.
+    """
+    if null:
+        batch = parse_batch_null(batch_fp, project, session)
+    else:
+        batch = parse_batch(batch_fp, project, session)
+    if not batch:
+        return
+
+    conn = db_conn(config)
+    try:
+        save_executions(conn, batch)
+    finally:
+        close_conn(conn)
+
+
+def send_to_daemon(config: dict, request: dict) -> bool:
+    """
+    Send a single request to a running daemon. Returns False if no daemon is
+    listening, so the caller can fall back to doing the work itself.
+
+    Once the request is sent we never fall back, as the daemon may yet save
+    it: should the daemon not reply within DAEMON_TIMEOUT, we assume it
+    will, rather than risk saving the command twice.
+    """
+    import json
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(DAEMON_TIMEOUT)
+    try:
+        try:
+            sock.connect(config['socket'])
+            sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        except OSError:
+            # No daemon is listening, or it isn't accepting connections. A
+            # partially sent request is never complete, so isn't saved.
+            return False
+
+        try:
+            reply = sock.makefile('r', encoding='utf-8').readline().strip()
+        except socket.timeout:
+            return True
+    finally:
+        sock.close()
+
+    if reply != "ok":
+        raise Exception("Daemon failed to handle request: " + reply)
+
+    return True
+
+
+def daemon_request(request: dict) -> tuple:
+    """
+    Validate a single request sent to the daemon over its socket, returning
+    the (command, project, session, pwd) execution to save.
+    """
+    if not isinstance(request, dict) or request.get("cmd") != "save":
+        raise ValueError("Unknown daemon request")
+
+    for key in ("command", "project", "session", "pwd"):
+        if not isinstance(request.get(key), str):
+            raise ValueError("Daemon request key %s missing or not of type str" % key)
+
+    return (request["command"], request["project"], request["session"],
+            request["pwd"])
+
+
+def hist_daemon(config: dict):
+    """
+    Handle the command line subcommand "daemon": hold a single database
+    connection open and save commands sent over a Unix socket. This avoids
+    paying for process startup and connection setup on every shell prompt.
+
+    Saves are group committed: we acknowledge a request once it is queued,
+    and write the queue in one transaction once DAEMON_BATCH_SIZE requests
+    are waiting or the oldest has waited DAEMON_BATCH_DELAY seconds. A crash
+    can thus lose the last fraction of a second of history.
+
+    Requests are handled one at a time, so the connection is never shared
+    between threads.
+    """
+    import json
+    import signal
+    import socket
+    import socketserver
+    import stat
+    import time
+
+    class DaemonServer(socketserver.UnixStreamServer):
+        """
+        Server holding the daemon's connection and its queue of executions
+        waiting to be committed.
+        """
+
+        def __init__(self, path, conn):
+            super().__init__(path, DaemonHandler)
+            self.conn = conn
+            self.pending: list = []
+            self.pending_since: float = 0.0
+
+        def queue(self, execution: tuple):
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending.append(execution)
+
+        def maybe_flush(self):
+            if len(self.pending) >= DAEMON_BATCH_SIZE or \
+               (self.pending and
+                time.monotonic() - self.pending_since >= DAEMON_BATCH_DELAY):
+                self.flush()
+
+        def flush(self):
+            if not self.pending:
+                return
+
+            # Only dequeue the batch once it's committed, so that should we be
+            # interrupted part way (e.g., by SIGTERM), the final flush on
+            # shutdown still saves it.
+            batch = self.pending
+            try:
+                save_executions(self.conn, batch)
+            except Exception as exc:
+                # Another process holds the write lock; keep the batch queued
+                # and retry on a later poll rather than keep clients waiting.
+                if isinstance(exc, sqlite3.OperationalError) and \
+                   str(exc) == "database is locked":
+                    return
+
+                # Otherwise the clients were already acknowledged, so all we can do is
+                # report the loss.
+                print("Failed to save %d commands: %s" % (len(batch), exc),
+                      file=sys.stderr)
+            self.pending = []
+
+        def service_actions(self):
+            # Called by serve_forever(...) at least once per poll interval.
+            self.maybe_flush()
+
+    class DaemonHandler(socketserver.StreamRequestHandler):
+        """
+        Handler for a single client of the daemon. Each line sent by the
+        client is a JSON request; we reply to each with a line of "ok" or the
+        error.
+        """
+
+        timeout = DAEMON_TIMEOUT
+
+        def handle(self):
+            try:
+                for line in self.rfile:
+                    try:
+                        self.server.queue(daemon_request(json.loads(line)))
+                        reply = "ok"
+                    except Exception as exc:
+                        reply = "error: %s" % exc
+                    self.wfile.write((reply + "\n").encode('utf-8'))
+
+                    # Only flush once the client has its reply, so it never
+                    # waits on our commit.
+                    self.server.maybe_flush()
+            except OSError:
+                # The client went idle (socket.timeout) or away; drop it so
+                # others can be served.
+                pass
+
+    path = config['socket']
+
+    # Clean up after a previous daemon which exited uncleanly, but refuse to
+    # steal the socket from one which is still running. Connecting to any
+    # other kind of file is refused too, so check that we'd only ever remove
+    # a socket.
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise Exception("Not a socket, refusing to replace: " + path)
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise Exception("Daemon already listening on socket: " + path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    # Only the current user should be able to write to their history.
+    old_umask = os.umask(0o077)
+    try:
+        server = DaemonServer(path, db_conn(config))
+    finally:
+        os.umask(old_umask)
+
+    # Don't block clients waiting on other writers; see DAEMON_BUSY_TIMEOUT.
+    busy_timeout = server.conn.execute("PRAGMA busy_timeout;").fetchone()[0]
+    server.conn.execute("PRAGMA busy_timeout=%d;" % DAEMON_BUSY_TIMEOUT)
+
+    # Treat SIGTERM like Ctrl-C, so queued commands are still written.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        server.serve_forever(poll_interval=DAEMON_BATCH_DELAY)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # With no clients left to serve, we can afford to wait on the lock
+        # for the final flush.
+        server.server_close()
+        server.conn.execute("PRAGMA busy_timeout=%d;" % busy_timeout)
+        server.flush()
+        close_conn(server.conn)
+        os.unlink(path)
 
 
 def parse_columns(table: str, cols: Tuple[str]):
@@ -209,28 +817,16 @@ def parse_columns(table: str, cols: Tuple[str]):
         raise ValueError("Expected one or more columns")
 
     for col in cols:
-        if col == "command":
-            columns.append("commands.value")
-            join_clauses.append("commands ON " + table + ".command_id=commands.ROWID")
-        elif col == "command_id":
-            columns.append(table + ".command_id")
-        elif col == "session":
-            columns.append("sessions.name")
-            join_clauses.append("sessions ON " + table + ".session_id=sessions.ROWID")
-        elif col == "session_id":
-            columns.append(table + ".session_id")
-        elif col == "project":
-            columns.append("projects.name")
-            join_clauses.append("projects ON " + table + ".project_id=projects.ROWID")
-        elif col == "project_id":
-            columns.append(table + ".project_id")
-        elif col == "pwd":
-            columns.append(table + ".pwd")
-        elif col == "exec_time":
-            columns.append(table + ".exec_time")
-        else:
+        if col not in COLUMN_MAP:
             raise ValueError("Unknown column: %s" % col)
 
+        expr, join_clause = COLUMN_MAP[col]
+        columns.append(expr.format(table=table))
+        if join_clause:
+            join_clause = join_clause.format(table=table)
+            if join_clause not in join_clauses:
+                join_clauses.append(join_clause)
+
     # We can blindly join columns together with a comma
     column = ",".join(columns)
 
@@ -240,15 +836,40 @@ def parse_columns(table: str, cols: Tuple[str]):
         #   <SELECT...> JOIN <condition> [JOIN <condition>....] <WHERE...>
         # So emulate it by joining the conditions with JOIN, and prepending
         # one additional JOIN.
-        join = " JOIN " + " JOIN ".join(join_clauses)
+        join = "JOIN " + " JOIN ".join(join_clauses)
 
     return column, join
 
 
-def parse_values(table: str, session_id: OInt = None, project_id: OInt = None):
+@functools.lru_cache(maxsize=64)
+def compile_regex(pattern: str):
+    """
+    Compile a regex, caching the result. SQLite calls our REGEXP function
+    once per row with the same pattern, so this must be cheap on a hit.
+    """
+    return re.compile(pattern)
+
+
+def sql_regexp(pattern: str, value: Optional[str]) -> bool:
+    """
+    Implementation of SQLite's REGEXP operator: "value REGEXP pattern" is
+    evaluated as regexp(pattern, value).
+    """
+    if value is None:
+        return False
+    return compile_regex(pattern).search(value) is not None
+
+
+def parse_values(table: str, session_id: OInt = None, project_id: OInt = None,
+                 command_regex: Optional[str] = None, after_id: OInt = None,
+                 until_id: OInt = None):
     """
     Parse the parameterized values and WHERE constraint clauses from the
-    passed values we're given.
+    passed values we're given. after_id and until_id bound the ROWIDs of
+    the executions, exclusive and inclusive respectively.
+
+    When command_regex is given, the commands table must be joined in by the
+    caller.
     """
     where_clauses = []
     values = []
@@ -259,138 +880,289 @@ def parse_values(table: str, session_id: OInt = None, project_id: OInt = None):
     if project_id:
         where_clauses.append(table + ".project_id=?")
         values.append(project_id)
+    if after_id is not None:
+        where_clauses.append(table + ".ROWID>?")
+        values.append(after_id)
+    if until_id is not None:
+        where_clauses.append(table + ".ROWID<=?")
+        values.append(until_id)
+    if command_regex:
+        # Filter commands inside SQLite so non-matching rows never cross
+        # into Python. The regex may match anywhere in the command, like
+        # grep; literal patterns become a case-sensitive substring GLOB,
+        # which avoids calling back into Python for every row. A leading
+        # "^" anchors a literal to the start of the command. We don't treat
+        # a trailing "$" the same way, as in Python it also matches before
+        # a final newline.
+        anchored = command_regex.startswith("^")
+        literal = command_regex[1:] if anchored else command_regex
+        if REGEX_SPECIAL.isdisjoint(literal):
+            where_clauses.append("commands.value GLOB ?")
+            values.append(("" if anchored else "*") + literal + "*")
+        else:
+            where_clauses.append("commands.value REGEXP ?")
+            values.append(command_regex)
 
     where = ""
     if where_clauses:
         # We assume the conjunction here is AND.
-        where = " WHERE " + " AND ".join(where_clauses)
+        where = "WHERE " + " AND ".join(where_clauses)
 
     return where, values
 
 
+@functools.lru_cache(maxsize=32)
+def build_query(cols: Tuple[str, ...], where: str, join_command: bool,
+                by_time: bool) -> str:
+    """
+    Build the SELECT statement for get_history(...) from the selected columns
+    and WHERE clause. When join_command is set, the commands table is joined
+    in even if the command itself isn't selected, as the WHERE clause
+    filters on it. When by_time is set, results are ordered by exec_time,
+    otherwise by ROWID.
+
+    Callers only use a handful of shapes of query, so this is memoized.
+    """
+    column, join = parse_columns(EXEC_TABLE, cols)
+
+    # Build the query from its non-empty parts.
+    parts = ["SELECT", column, "FROM", EXEC_TABLE]
+    if join:
+        parts.append(join)
+    if join_command and "command" not in cols:
+        parts.append("JOIN " + COLUMN_MAP["command"][1].format(table=EXEC_TABLE))
+    if where:
+        parts.append(where)
+
+    # Executions are only ever inserted, with exec_time defaulting to the
+    # time of the insert, so ROWID order is also exec_time order. Ordering by
+    # ROWID lets SQLite walk the table in order rather than sort it; when we
+    # filter by session or project, the indexes on exec_time provide the
+    # order instead.
+    #
+    # exec_time only has a resolution of a second, so break ties by ROWID to
+    # keep commands saved within the same second in the order they were run.
+    # The indexes on exec_time also order by ROWID, so this is free.
+    if by_time:
+        parts.append("ORDER BY exec_time ASC, " + EXEC_TABLE + ".ROWID ASC;")
+    else:
+        parts.append("ORDER BY " + EXEC_TABLE + ".ROWID ASC;")
+
+    return " ".join(parts)
+
+
 def get_history(conn, session_id: OInt = None, project_id: OInt = None,
-                cols: ColumnsType = "command") -> Generator:
+                cols: ColumnsType = "command",
+                command_regex: Optional[str] = None, after_id: OInt = None,
+                until_id: OInt = None, raw: bool = False) -> Generator:
     """
     Get a history of command executions from the database, filtering by
-    session_id and project_id if present, and only showing the specified
-    columns. When cols is a single element, the result will be a list of
-    elements.
+    session_id, project_id, command_regex, and the range of execution ROWIDs
+    (after_id, until_id] if present, and only showing the specified
+    columns. When cols is a single element, each result is the
+    bare value; otherwise it is a dictionary keyed by column. With raw, each
+    result is instead the row tuple as returned by SQLite, in cols order.
+
+    Rows are streamed from SQLite as the generator is consumed, so it must be
+    consumed before the connection is closed.
     """
-    cur = conn.cursor()
-
     # We assume cols is a tuple of strings, but allow it to be a lone string
     # in the case of a single column.
     if isinstance(cols, str):
         cols = (cols,)
+    cols = tuple(cols)
 
-    column: str = ""
-    join: str = ""
     where: str = ""
     values: list = []
 
-    # Parse parameters into a SQL SELECT statement.
-    column, join = parse_columns(EXEC_TABLE, cols)
-    where, values = parse_values(EXEC_TABLE, session_id, project_id)
-
-    # Build the query
-    query = "SELECT " + column + " FROM " + EXEC_TABLE + join + where + " ORDER BY exec_time ASC;"
-    query = query.replace("  ", " ")
+    # Parse parameters into a SQL SELECT statement. Only the values vary
+    # between calls of the same shape, so the statement itself is memoized.
+    where, values = parse_values(EXEC_TABLE, session_id, project_id,
+                                 command_regex, after_id, until_id)
+    query = build_query(cols, where, bool(command_regex),
+                        bool(session_id or project_id))
+    if command_regex:
+        conn.create_function("REGEXP", 2, sql_regexp, deterministic=True)
 
-    # Execute the query, fetching all results.
-    cur.execute(query, values)
-    rows = cur.fetchall()
+    # Execute the query and stream results straight off the cursor rather
+    # than materializing the full history with fetchall(). The cursor stays
+    # open for as long as the caller is consuming the generator.
+    cur = conn.execute(query, values)
 
-    # Generator versus list;
-    for row in rows:
+    try:
         # Contract:
+        #   - raw <=> list of tuples;
         #   - cols == 1 <=> list of strings;
         #   - cols > 1 <=> list of dictionaries, keys are columns
+        if raw:
+            yield from cur
+            return
         if len(cols) == 1:
-            yield row[0]
-        else:
-            result = {}
-            for c_id, col in enumerate(cols):
-                result[col] = row[c_id]
-            yield result
+            yield from (row[0] for row in cur)
+            return
 
-    cur.close()
+        # dict(zip(...)) builds each row in C rather than looping over the
+        # columns in Python.
+        for row in cur:
+            yield dict(zip(cols, row))
+    finally:
+        cur.close()
 
 
-def write_history(history: Iterable, path: str):
+def write_history(history: Iterable, history_file):
     """
-    Write history to the specified path. This assumes that history is a
+    Write history to the specified file. This assumes that history is a
     Iterbale of strings.
     """
-    history_file = open(path, 'w')
-    for line in history:
-        history_file.write("%s\n" % line)
-    history_file.flush()
-    history_file.close()
+    # writelines(...) keeps the per-line loop out of Python.
+    history_file.writelines(line + "\n" for line in history)
+
 
+def write_history_file(conn, path: str, append: bool,
+                       session_id: OInt = None, project_id: OInt = None):
+    """
+    Write the history of the given session or project to path. With append,
+    when we've written to path before and it still exists, only the
+    executions since are appended.
 
-def hist_write(config: dict, session: str, project: str):
+    Every shell may write the same file, so we hold an exclusive lock on it
+    from reading what was last written until we've recorded what we wrote.
+    Otherwise two concurrent appends could both write the same executions.
+    """
+    import fcntl
+
+    exists = os.path.exists(path)
+
+    # Opening for append doesn't truncate, so we can take the lock before
+    # deciding whether to rewrite the file. A large buffer collapses the
+    # many short lines into a few large writes.
+    with open(path, 'a', buffering=1 << 16) as history_file:
+        fcntl.flock(history_file, fcntl.LOCK_EX)
+
+        # Fix the last execution to write, so that we know exactly what was
+        # written even if other shells save meanwhile.
+        with conn:
+            conn.execute("BEGIN;")
+            until_id = conn.execute(SELECT_LAST_EXEC_SQL).fetchone()[0] or 0
+            after_id = None
+            if append and exists:
+                row = conn.execute(SELECT_WRITE_SQL, (path,)).fetchone()
+                if row is not None:
+                    after_id = row[0]
+
+        if after_id is None:
+            history_file.truncate(0)
+
+        history = get_history(conn, session_id=session_id,
+                              project_id=project_id, after_id=after_id,
+                              until_id=until_id)
+        write_history(history, history_file)
+        history_file.flush()
+
+        # Only record the file once it's been written; should we fail before
+        # then, the next append starts over from the previous write.
+        with conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            conn.execute(INSERT_WRITE_SQL, (path, until_id))
+
+
+def hist_write(config: dict, session: str, project: str,
+               append: bool = False):
     """
     Handle the command line subcommand "write": write the existing history to
-    a bash_history file.
+    a bash_history file. With append, only the history since the last write
+    is appended to each file.
     """
     conn = db_conn(config)
 
-    session_id = save_session(conn, session)
+    try:
+        # Commit the id lookups straight away: they may insert a new session
+        # or project, and we don't want to hold the write lock (and block
+        # other shells from saving) while writing out history files.
+        with conn:
+            conn.execute("BEGIN;")
+            cur = conn.cursor()
+            session_id = save_session(cur, session)
+            project_id = None
+            if project in config['projects_map']:
+                project_id = save_project(cur, project)
+
+        session_file = "%d.hist-ng" % session_id
+        session_path = os.path.abspath(os.path.join(config['sessions_dir'],
+                                                    session_file))
+        write_history_file(conn, session_path, append, session_id=session_id)
+
+        if project in config['projects_map']:
+            project_index = config['projects_map'][project]
+            project_config = config['projects'][project_index]
+
+            if 'hist_file' in project_config:
+                project_path = os.path.abspath(project_config['hist_file'])
+                write_history_file(conn, project_path, append,
+                                   project_id=project_id)
+    finally:
+        close_conn(conn)
+
+
+def compile_format(format_str: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Compile a list format string (e.g., "%i %c") into a str.format template
+    and the tuple of history columns it references. Everything is referenced
+    positionally, so a row holding the values of those columns, in order, is
+    formatted with template.format(index, *row).
 
-    session_file = "%d.hist-ng" % session_id
-    session_path = os.path.join(config['sessions_dir'], session_file)
-    session_history = get_history(conn, session_id=session_id)
-    write_history(session_history, session_path)
+    This lets us scan the format string once, rather than once per row.
+    """
+    fields: list = []
 
-    if project in config['projects_map']:
-        project_id = save_session(conn, project)
-        project_index = config['projects_map'][project]
-        project_config = config['projects'][project_index]
+    def translate(match) -> str:
+        spec = match.group(1)
+        if spec is None:
+            # Literal braces must be escaped for str.format.
+            return match.group(0) * 2
 
-        if 'hist_file' in project_config:
-            project_path = project_config['hist_file']
-            project_history = get_history(conn, project_id=project_id)
-            write_history(project_history, project_path)
+        if spec == 'i':
+            return "{0}"
+        if spec in FORMAT_FIELDS:
+            field = FORMAT_FIELDS[spec]
+            if field not in fields:
+                fields.append(field)
+            return "{%d}" % (fields.index(field) + 1)
+        if spec == '%':
+            return "%"
 
-    conn.commit()
-    conn.close()
+        # Unknown specifiers are kept as is.
+        if spec in ("{", "}"):
+            spec *= 2
+        return "%" + spec
 
+    template = FORMAT_RE.sub(translate, format_str)
 
-def format_history(index: int, item: dict, format_str: str, _file=sys.stdout):
-    """
-    From a format string, write a history item to stdout.
-    """
-    i: int = 0
-    line: str = ""
-    while i < len(format_str):
-        char = format_str[i]
-        next_char = ""
-        if i + 1 < len(format_str):
-            next_char = format_str[i+1]
-
-        if char == '%':
-            if next_char == 'i':
-                line += str(index)
-            elif next_char == 'c':
-                line += item['command']
-            elif next_char == 's':
-                line += item['session']
-            elif next_char == 'p':
-                line += item['project']
-            elif next_char == 'd':
-                line += item['pwd']
-            elif next_char == 't':
-                line += item['exec_time']
-            elif next_char == '%':
-                line += "%"
-            else:
-                line += char + next_char
-            i += 2
-            continue
+    return template, tuple(fields)
+
+
+def write_lines(lines: Iterable[str], _file=None,
+                buffer_size: int = 1 << 15):
+    """
+    Write already newline-terminated lines to _file (by default, the current
+    sys.stdout), joining them into writes of roughly buffer_size characters.
+    """
+    if _file is None:
+        _file = sys.stdout
 
-        line += char
-        i += 1
-    print(line)
+    buf: list = []
+    size: int = 0
+    for line in lines:
+        buf.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            _file.write("".join(buf))
+            buf.clear()
+            size = 0
+
+    if buf:
+        _file.write("".join(buf))
+    _file.flush()
 
 
 def hist_list(config, session, project, command, format_str):
@@ -400,32 +1172,56 @@ def hist_list(config, session, project, command, format_str):
     """
     conn = db_conn(config)
 
-    # When specified, filter by session and project name
-    session_id = None
-    project_id = None
-    if session:
-        session_id = save_session(conn, session)
-    if project:
-        project_id = save_project(conn, project)
-
-    # Get all session history: this ends up being a Generator of dictionaries.
-    session_history = get_history(conn, session_id=session_id,
-                                  project_id=project_id,
-                                  cols=["command", "session", "project", "pwd", "exec_time"])
-
-    # When specified, this regex is used to limit the command list.
-    cmd_regex = None
-    if command:
-        cmd_regex = re.compile(command)
-
-    index: int = 0
-    for line in session_history:
-        if cmd_regex is None or cmd_regex.match(line["command"]):
-            format_history(index+1, line, format_str)
-            index += 1
-
-    conn.commit()
-    conn.close()
+    try:
+        # When specified, filter by session and project name. See comments
+        # in hist_write(...) about committing these straight away.
+        session_id = None
+        project_id = None
+        with conn:
+            conn.execute("BEGIN;")
+            cur = conn.cursor()
+            if session:
+                session_id = save_session(cur, session)
+            if project:
+                project_id = save_project(cur, project)
+
+        # When specified, this regex is used to limit the command list. We
+        # compile it here so an invalid pattern is reported as such, rather
+        # than as an error from within SQLite.
+        if command:
+            compile_regex(command)
+
+        # Parse the format string once, up front, and only select the
+        # columns it references. We still need a column to count the rows
+        # when it references none; command_id needs no join.
+        template, fields = compile_format(format_str)
+        cols = fields or ("command_id",)
+
+        # Get all session history: this ends up being a Generator of row
+        # tuples, which we format directly rather than building a dictionary
+        # per row.
+        session_history = get_history(conn, session_id=session_id,
+                                      project_id=project_id, cols=cols,
+                                      command_regex=command, raw=True)
+
+        # All substitution happens in C; rows are never modified. Close the
+        # generator explicitly so its cursor is released before the
+        # connection, even if printing fails part way.
+        #
+        # Interactive output is printed a line at a time so it appears as
+        # it is found; otherwise (e.g., when piped to grep) we batch lines
+        # into a few large writes.
+        try:
+            if sys.stdout.isatty():
+                for index, row in enumerate(session_history, 1):
+                    print(template.format(index, *row))
+            else:
+                write_lines(template.format(index, *row) + "\n"
+                            for index, row in enumerate(session_history, 1))
+        finally:
+            session_history.close()
+    finally:
+        close_conn(conn)
 
 
 def parse_args():
@@ -448,7 +1244,7 @@ def parse_args():
     if project_value:
         project_required = None
 
-    parser.add_argument('-c', '--config', type=argparse.FileType('r'),
+    parser.add_argument('-c', '--config', type=str,
                         default=config_value,
                         help="Location of hist_ng configuration file.")
 
@@ -463,9 +1259,33 @@ def parse_args():
                              default=project_value, required=project_required,
                              help="Context or project to save the command in; " +
                              "defaults to the value of HIST_NG_PROJECT")
+    save_action.add_argument('-d', '--via-daemon', action='store_true',
+                             help="Hand the command to a running daemon, " +
+                             "saving it directly if none is running",
+                             required=False)
     save_action.add_argument('command', help="Command to save")
     save_action.set_defaults(which='save')
 
+    batch_action = subparsers.add_parser('save-batch')
+    batch_action.add_argument('-s', '--session', type=str,
+                              default=session_value,
+                              help="Default session for commands without " +
+                              "one; defaults to the value of HIST_NG_SESSION")
+    batch_action.add_argument('-p', '--project', type=str,
+                              default=project_value,
+                              help="Default project for commands without " +
+                              "one; defaults to the value of HIST_NG_PROJECT")
+    batch_action.add_argument('-0', '--null', action='store_true',
+                              help="Read NUL-terminated command, project, " +
+                              "and session fields instead of JSON lines",
+                              required=False)
+    batch_action.add_argument('batch', nargs='?', type=argparse.FileType('r'),
+                              default=sys.stdin,
+                              help="File of commands to save, as JSON " +
+                              "lines or, with -0, NUL-terminated fields; " +
+                              "defaults to stdin")
+    batch_action.set_defaults(which='save-batch')
+
     write_action = subparsers.add_parser('write')
     write_action.add_argument('-s', '--session', type=str,
                               default=session_value, required=session_required,
@@ -496,6 +1316,9 @@ def parse_args():
                              required=False)
     list_action.set_defaults(which='list')
 
+    daemon_action = subparsers.add_parser('daemon')
+    daemon_action.set_defaults(which='daemon')
+
     args = parser.parse_args()
     if 'which' not in args:
         parser.print_help()
@@ -504,29 +1327,49 @@ def parse_args():
     return args
 
 
-def parse_config(config_fp):
+def ensure_dir(path: str):
+    """
+    Create the directory at path if it doesn't already exist. Checking first
+    costs a single stat() in the common case, where os.makedirs(...) would
+    try (and fail) to mkdir() before checking.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+
+
+def parse_config(config_path: str):
+    """
+    From the path to the configuration, parse and validate it. A path of "-"
+    reads the configuration from stdin.
+    """
+    if config_path == "-":
+        config = validate_config(sys.stdin)
+    else:
+        with open(config_path, 'r') as config_fp:
+            config = validate_config(config_fp)
+
+    ensure_dir(config['sessions_dir'])
+
+    return config
+
+
+def validate_config(config_fp):
     """
     From a file pointer to the configuration, parse it and validate the
     structure of the JSON object is as expected.
     """
+    import json
+
     config = json.load(config_fp)
     config_path = config_fp.name
 
-    # Validate "database" config value
-    if "database" not in config:
-        raise ValueError("Missing global key database in configuration: " +
-                         config_path)
-    if not isinstance(config['database'], str):
-        raise ValueError("Global key database not of type str in " +
-                         "configuration: " + config_path)
-
-    # Validate "sessions_dir" config value
-    if "sessions_dir" not in config:
-        raise ValueError("Missing global key sessions_dir in configuration: " +
-                         config_path)
-    if not isinstance(config['sessions_dir'], str):
-        raise ValueError("Global key sessions_dir not of type str in " +
-                         "configuration: " + config_path)
+    for key, key_type in REQUIRED_CONFIG_KEYS:
+        if key not in config:
+            raise ValueError("Missing global key %s in configuration: %s" %
+                             (key, config_path))
+        if not isinstance(config[key], key_type):
+            raise ValueError("Global key %s not of type %s in configuration: %s" %
+                             (key, key_type.__name__, config_path))
 
     # Validate "projects" config value
     if "projects" not in config:
@@ -548,14 +1391,21 @@ def parse_config(config_fp):
                                  (p_id+1, config_path))
             project["hist_file"] = os.path.expanduser(project["hist_file"])
 
+    # Validate the optional "socket" config value
+    if "socket" not in config:
+        config['socket'] = os.path.join(HOME_DIR, ".hist_ng", "sock")
+    if not isinstance(config['socket'], str):
+        raise ValueError("Global key socket not of type str in " +
+                         "configuration: " + config_path)
+
     if 'default' not in projects_map:
         raise ValueError("Missing subkey default of global key projects " +
                          "in configuration: " + config_path)
 
     config['database'] = os.path.expanduser(config['database'])
     config['sessions_dir'] = os.path.expanduser(config['sessions_dir'])
+    config['socket'] = os.path.expanduser(config['socket'])
     config['projects_map'] = projects_map
-    os.makedirs(config['sessions_dir'], exist_ok=True)
 
     return config
 
@@ -565,15 +1415,30 @@ def main():
     Main method for handling command line arguments.
     """
     args = parse_args()
-    config = parse_config(args.config)
+    try:
+        config = parse_config(args.config)
+    except OSError as exc:
+        # Report failing to read the configuration itself like argparse
+        # would have, were it opening the file.
+        if exc.filename != args.config:
+            raise
+        print("hist-ng: error: argument -c/--config: can't open '%s': %s" %
+              (args.config, exc.strerror or exc), file=sys.stderr)
+        sys.exit(2)
 
     if args.which == 'save':
-        hist_save(config, args.command, args.project, args.session)
+        hist_save(config, args.command, args.project, args.session,
+                  args.via_daemon)
+    elif args.which == 'save-batch':
+        hist_save_batch(config, args.batch, args.project, args.session,
+                        args.null)
     elif args.which == 'write':
-        hist_write(config, args.session, args.project)
+        hist_write(config, args.session, args.project, args.append)
     elif args.which == 'list':
         hist_list(config, args.session, args.project, args.command,
                   args.format)
+    elif args.which == 'daemon':
+        hist_daemon(config)
 
 
 if __name__ == "__main__":